@@ -22,53 +22,640 @@
 #    this script, as it will overwrite the original files.
 # 4. Run the script from your terminal: python merge_metadata.py
 
+import atexit
+import bisect
+import collections
+import errno
+import functools
 import os
 import json
+import mmap
 import re
+import queue
 import shutil
+import struct
+import subprocess
+import threading
+import time
+import zlib
 import piexif
 import mutagen
+import mutagen.mp4
 import logging
-from datetime import datetime, timezone
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageFile
-import pillow_heif
+
+# orjson parses the Takeout sidecar JSONs several times faster than the
+# stdlib parser; fall back to the stdlib when it is not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Allow loading of truncated images, which can prevent errors with corrupted files.
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-# Register the HEIF opener with Pillow
-pillow_heif.register_heif_opener()
+# pillow_heif is imported lazily: importing it and registering the HEIF
+# opener initializes the HEVC codec, which costs startup time and memory
+# on every run even when the library contains no HEIC files at all.
+pillow_heif = None
+
+def _ensure_heif():
+    """Imports pillow_heif and registers its Pillow opener on first use."""
+    global pillow_heif
+    if pillow_heif is None:
+        import pillow_heif as _pillow_heif
+        _pillow_heif.register_heif_opener()
+        pillow_heif = _pillow_heif
+
+# Module logger; hot-path messages use %-style arguments so the string is
+# only formatted when the record is actually emitted.
+logger = logging.getLogger(__name__)
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _strip_exif_header(exif_bytes):
+    """PNG/WEBP chunks store raw TIFF data, without the APP1 'Exif\\0\\0' tag."""
+    if exif_bytes.startswith(b'Exif\x00\x00'):
+        return exif_bytes[6:]
+    return exif_bytes
+
+def write_png_exif(filepath, exif_bytes):
+    """
+    Splices an eXIf chunk (PNG 1.5) into an existing PNG, replacing any old
+    one, without decoding or re-encoding the pixel data. Returns True on
+    success, False if the file doesn't look like a PNG we can patch.
+    """
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    if not data.startswith(_PNG_SIGNATURE):
+        return False
+
+    payload = _strip_exif_header(exif_bytes)
+    exif_chunk = (struct.pack('>I', len(payload)) + b'eXIf' + payload
+                  + struct.pack('>I', zlib.crc32(b'eXIf' + payload) & 0xffffffff))
+
+    parts = [data[:8]]
+    position, inserted = 8, False
+    while position + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        chunk_end = position + 12 + length
+        if chunk_type == b'eXIf':
+            pass  # drop the stale chunk
+        else:
+            if not inserted and chunk_type in (b'IDAT', b'IEND'):
+                parts.append(exif_chunk)
+                inserted = True
+            parts.append(data[position:chunk_end])
+        position = chunk_end
+    if not inserted:
+        return False
+
+    with open(filepath, 'wb') as f:
+        f.write(b''.join(parts))
+    return True
+
+def write_webp_exif(filepath, exif_bytes):
+    """
+    Replaces/appends the EXIF chunk in a WEBP RIFF container without
+    re-encoding the image. Only extended (VP8X) files are patched - adding a
+    VP8X header to a simple lossy/lossless file would require parsing the
+    bitstream for the canvas size, which is left to the Pillow fallback.
+    Returns True on success.
+    """
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return False
+
+    chunks = []
+    position, has_vp8x = 12, False
+    while position + 8 <= len(data):
+        fourcc = data[position:position + 4]
+        size = struct.unpack('<I', data[position + 4:position + 8])[0]
+        body = data[position + 8:position + 8 + size]
+        if len(body) != size:
+            return False  # truncated container; don't touch it
+        if fourcc == b'VP8X':
+            has_vp8x = True
+            body = bytes([body[0] | 0x08]) + body[1:]  # set the EXIF flag
+        if fourcc != b'EXIF':
+            chunks.append((fourcc, body))
+        position += 8 + size + (size & 1)
+    if not has_vp8x:
+        return False
+    chunks.append((b'EXIF', _strip_exif_header(exif_bytes)))
+
+    body_out = bytearray()
+    for fourcc, body in chunks:
+        body_out += fourcc + struct.pack('<I', len(body)) + body
+        if len(body) & 1:
+            body_out += b'\x00'
+
+    with open(filepath, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body_out) + 4) + b'WEBP' + body_out)
+    return True
+
+def read_png_exif(filepath):
+    """
+    Returns the raw eXIf payload of a PNG, or b'' if there is none. Walks
+    only the chunk headers (seeking over the data), so nothing is decoded
+    and the pixel chunks are never read.
+    """
+    with open(filepath, 'rb') as f:
+        if f.read(8) != _PNG_SIGNATURE:
+            return b''
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return b''
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'eXIf':
+                return f.read(length)
+            if chunk_type == b'IEND':
+                return b''
+            f.seek(length + 4, 1)  # skip data + CRC
+
+def read_webp_exif(filepath):
+    """Returns the raw EXIF chunk payload of a WEBP, or b'' if absent."""
+    with open(filepath, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WEBP':
+            return b''
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return b''
+            fourcc, size = struct.unpack('<4sI', chunk_header)
+            if fourcc == b'EXIF':
+                return f.read(size)
+            f.seek(size + (size & 1), 1)
 
-def to_deg(value, loc):
-    """Converts a decimal degree value to degrees, minutes, seconds."""
-    if value < 0:
-        loc_value = loc[1]
-    elif value > 0:
-        loc_value = loc[0]
+def _find_jpeg_date_offsets(f):
+    """
+    Walks an open JPEG to its Exif APP1 and locates the three date tags
+    (DateTime in the 0th IFD, DateTimeOriginal/Digitized in the Exif IFD).
+    Returns (tiff_abs, [value_offset, ...]) where each offset, relative to
+    tiff_abs in the file, holds a 20-byte ASCII date value - or None when
+    there is no Exif APP1 or any tag is missing/oddly shaped.
+    """
+    if f.read(2) != b'\xff\xd8':
+        return None
+    # Walk the marker segments looking for the Exif APP1.
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF or marker[1] in (0xD9, 0xDA):
+            return None
+        (seg_len,) = struct.unpack('>H', f.read(2))
+        if marker[1] == 0xE1:
+            seg_start = f.tell()
+            segment = f.read(seg_len - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                break
+        else:
+            f.seek(seg_len - 2, 1)
+
+    tiff = segment[6:]
+    tiff_abs = seg_start + 6
+    if tiff[:2] == b'II':
+        fmt = '<'
+    elif tiff[:2] == b'MM':
+        fmt = '>'
     else:
-        loc_value = ""
-    abs_value = abs(value)
-    deg = int(abs_value)
-    t1 = (abs_value - deg) * 60
-    min = int(t1)
-    sec = round((t1 - min) * 60, 5)
-    return (deg, 1), (min, 1), (int(sec*100000), 100000), loc_value.encode('utf-8')
+        return None
+
+    def read_u16(offset):
+        return struct.unpack_from(fmt + 'H', tiff, offset)[0]
+
+    def read_u32(offset):
+        return struct.unpack_from(fmt + 'I', tiff, offset)[0]
+
+    def scan_ifd(ifd_offset, wanted_tags):
+        """Maps each wanted tag to the offset of its 20-byte ASCII value."""
+        found = {}
+        for i in range(read_u16(ifd_offset)):
+            entry = ifd_offset + 2 + 12 * i
+            tag = read_u16(entry)
+            if tag in wanted_tags:
+                # Type 2 is ASCII; a 20-byte value never fits inline, so
+                # the last field is always an offset into the TIFF data.
+                if read_u16(entry + 2) == 2 and read_u32(entry + 4) == 20:
+                    found[tag] = read_u32(entry + 8)
+        return found
+
+    try:
+        ifd0 = read_u32(4)
+        zeroth = scan_ifd(ifd0, (piexif.ImageIFD.DateTime,))
+        exif_ptr = None
+        for i in range(read_u16(ifd0)):
+            entry = ifd0 + 2 + 12 * i
+            if read_u16(entry) == piexif.ImageIFD.ExifTag:
+                exif_ptr = read_u32(entry + 8)
+                break
+        if exif_ptr is None or piexif.ImageIFD.DateTime not in zeroth:
+            return None
+        sub = scan_ifd(exif_ptr, (piexif.ExifIFD.DateTimeOriginal,
+                                  piexif.ExifIFD.DateTimeDigitized))
+        if len(sub) != 2:
+            return None
+    except struct.error:
+        return None
+
+    offsets = [zeroth[piexif.ImageIFD.DateTime]] + list(sub.values())
+    if any(offset + 20 > len(tiff) for offset in offsets):
+        return None
+    return tiff_abs, offsets
+
+def patch_jpeg_dates(filepath, date_str):
+    """
+    Overwrites DateTime, DateTimeOriginal and DateTimeDigitized inside a
+    JPEG's existing APP1/Exif segment without parsing any other tag. The
+    EXIF date format is a fixed 20-byte ASCII value, so when all three tags
+    are already present the new value fits exactly where the old one was.
+    Returns True on success; False means the caller should fall back to the
+    full piexif load/dump cycle (no EXIF segment, or a tag is missing).
+    """
+    date_value = date_str.encode('ascii') + b'\x00'
+    with open(filepath, 'r+b') as f:
+        located = _find_jpeg_date_offsets(f)
+        if located is None:
+            return False
+        tiff_abs, offsets = located
+        for value_offset in offsets:
+            f.seek(tiff_abs + value_offset)
+            f.write(date_value)
+    return True
+
+def jpeg_dates_match(filepath, date_str):
+    """
+    True when all three EXIF date tags of a JPEG already carry date_str -
+    the re-run case, where no metadata write is needed at all. Any parse
+    trouble just reports a mismatch so the normal write path runs.
+    """
+    date_value = date_str.encode('ascii') + b'\x00'
+    try:
+        with open(filepath, 'rb') as f:
+            located = _find_jpeg_date_offsets(f)
+            if located is None:
+                return False
+            tiff_abs, offsets = located
+            for value_offset in offsets:
+                f.seek(tiff_abs + value_offset)
+                if f.read(20) != date_value:
+                    return False
+    except Exception:
+        return False
+    return True
+
+def _try_patch_jpeg_dates(filepath, date_str):
+    """patch_jpeg_dates with any parse error downgraded to 'not patched'."""
+    try:
+        return patch_jpeg_dates(filepath, date_str)
+    except Exception:
+        return False
+
+def patch_jpeg_app1(filepath, exif_bytes):
+    """
+    Overwrites a JPEG's existing Exif APP1 payload in place when the new
+    one (piexif.dump output, 'Exif\\x00\\x00' header included) fits in the
+    old segment. The segment length is kept and the slack is zero-padded;
+    EXIF readers follow the IFD offsets and never look at the tail, while
+    rewriting the length would mean shifting the whole file anyway.
+    Returns False when there is no Exif APP1 or the new payload is larger,
+    in which case piexif.insert has to rewrite the file.
+    """
+    with open(filepath, 'r+b') as f:
+        if f.read(2) != b'\xff\xd8':
+            return False
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF or marker[1] in (0xD9, 0xDA):
+                return False
+            (seg_len,) = struct.unpack('>H', f.read(2))
+            seg_start = f.tell()
+            if marker[1] == 0xE1 and f.read(6) == b'Exif\x00\x00':
+                old_payload_len = seg_len - 2
+                if len(exif_bytes) > old_payload_len:
+                    return False
+                f.seek(seg_start)
+                f.write(exif_bytes + b'\x00' * (old_payload_len - len(exif_bytes)))
+                return True
+            f.seek(seg_start + seg_len - 2)
+
+# Seconds between the MP4 epoch (1904-01-01) and the Unix epoch.
+_MP4_EPOCH_OFFSET = 2082844800
+
+def patch_mp4_creation_time(filepath, timestamp):
+    """
+    Sets the creation_time in the mvhd and every tkhd atom of an MP4/MOV
+    by overwriting the fields in place through mmap. A mutagen save on a
+    multi-GB video rewrites the whole moov box just to change one value;
+    this touches a handful of bytes instead. Returns True once at least
+    one header atom was patched; False means fall back to mutagen.
+    """
+    mp4_time = timestamp + _MP4_EPOCH_OFFSET
+    if mp4_time < 0:
+        return False
+    patched = False
+    with open(filepath, 'r+b') as f, mmap.mmap(f.fileno(), 0) as mapped:
+
+        def children(start, end):
+            """Yields (type, payload_start, payload_end) for each child atom."""
+            pos = start
+            while pos + 8 <= end:
+                size, atom_type = struct.unpack_from('>I4s', mapped, pos)
+                header = 8
+                if size == 1:
+                    if pos + 16 > end:
+                        return
+                    (size,) = struct.unpack_from('>Q', mapped, pos + 8)
+                    header = 16
+                elif size == 0:
+                    size = end - pos
+                if size < header or pos + size > end:
+                    return
+                yield atom_type, pos + header, pos + size
+                pos += size
+
+        def patch_time_field(payload_start, payload_end):
+            # mvhd and tkhd share a layout: version(1) flags(3), then
+            # creation_time as 4 bytes (version 0) or 8 bytes (version 1).
+            nonlocal patched
+            version = mapped[payload_start] if payload_start < payload_end else None
+            if version == 0 and payload_start + 8 <= payload_end and mp4_time <= 0xFFFFFFFF:
+                struct.pack_into('>I', mapped, payload_start + 4, mp4_time)
+            elif version == 1 and payload_start + 12 <= payload_end:
+                struct.pack_into('>Q', mapped, payload_start + 4, mp4_time)
+            else:
+                return
+            patched = True
+
+        for atom_type, a_start, a_end in children(0, len(mapped)):
+            if atom_type != b'moov':
+                continue
+            for child_type, c_start, c_end in children(a_start, a_end):
+                if child_type == b'mvhd':
+                    patch_time_field(c_start, c_end)
+                elif child_type == b'trak':
+                    for sub_type, s_start, s_end in children(c_start, c_end):
+                        if sub_type == b'tkhd':
+                            patch_time_field(s_start, s_end)
+            break
+    return patched
+
+# The script only ever reads photoTakenTime.timestamp and the geoData
+# coordinates, so pull them straight out of the raw bytes with regexes and
+# skip tokenizing the dozens of unused keys in each Takeout JSON.
+_TIMESTAMP_RE = re.compile(rb'"photoTakenTime"\s*:\s*\{[^}]*"timestamp"\s*:\s*"(\d+)"')
+_GEODATA_RE = re.compile(rb'"geoData"\s*:\s*\{[^}]*"latitude"\s*:\s*(-?[\d.eE+-]+)\s*,\s*"longitude"\s*:\s*(-?[\d.eE+-]+)')
+
+@functools.lru_cache(maxsize=4096)
+def extract_metadata_fields(json_filepath):
+    """
+    Extracts (timestamp, latitude, longitude) from a Takeout sidecar JSON.
+    Returns (None, None, None) when the JSON has no photoTakenTime.
+    Well-formed Takeout files are handled by two precompiled regexes over
+    the raw bytes; anything unusual falls back to a full JSON parse.
+    Cached: an original and its '-edited' copy share one sidecar, so the
+    second lookup should not re-read the file.
+    """
+    with open(json_filepath, 'rb') as f:
+        raw = f.read()
+
+    ts_match = _TIMESTAMP_RE.search(raw)
+    if ts_match:
+        timestamp = int(ts_match.group(1))
+        lat, lon = None, None
+        geo_match = _GEODATA_RE.search(raw)
+        if geo_match:
+            lat, lon = float(geo_match.group(1)), float(geo_match.group(2))
+            if not lat:
+                # Takeout writes 0.0/0.0 when there is no GPS fix; treat it
+                # as absent, like the dict-based check always has.
+                lat, lon = None, None
+        return timestamp, lat, lon
+
+    # Fallback: full parse for files the fast path couldn't handle.
+    metadata = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    if 'photoTakenTime' not in metadata or 'timestamp' not in metadata['photoTakenTime']:
+        return None, None, None
+    timestamp = int(metadata['photoTakenTime']['timestamp'])
+    lat, lon = None, None
+    if 'geoData' in metadata and metadata['geoData'].get('latitude'):
+        lat, lon = metadata['geoData']['latitude'], metadata['geoData']['longitude']
+    return timestamp, lat, lon
+
+def fresh_exif_dict():
+    """A new, empty piexif-style EXIF structure (thumbnail already cleared)."""
+    return {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
+
+def _split_numbered_suffix(name):
+    """
+    Splits a trailing Takeout duplicate marker off a name:
+    'photo(1)' -> ('photo', '(1)'). Returns (name, '') when there is none.
+    Plain string scanning; cheaper than a backtracking regex per file.
+    """
+    if name.endswith(')'):
+        open_idx = name.rfind('(')
+        if open_idx >= 0 and name[open_idx + 1:-1].isdigit():
+            return name[:open_idx], name[open_idx:]
+    return name, ''
+
+# Destination folders already created under Completed this run; lets the
+# per-file makedirs become a set lookup after the first file in a folder.
+# (set.add/membership are atomic under the GIL, and a lost race just means
+# one extra makedirs with exist_ok=True - harmless.)
+_created_dirs = set()
+
+# Extensions whose container format is known up front, so the matching
+# mutagen class can be used directly instead of mutagen.File's sniffing.
+_VIDEO_CLASSES = {
+    'mp4': mutagen.mp4.MP4,
+    'mov': mutagen.mp4.MP4,
+}
+
+def to_deg(value, pos_ref, neg_ref):
+    """
+    Converts a decimal degree value to (((deg), (min), (sec)), hemisphere)
+    in the rational form piexif wants. The refs are passed in as bytes
+    (b'N'/b'S' or b'E'/b'W'), matching what EXIF stores.
+    """
+    ref = neg_ref if value < 0 else pos_ref if value > 0 else b''
+    # Work in hundred-thousandths of an arcsecond so degrees, minutes and
+    # seconds fall out of a single divmod chain - no repeated float
+    # multiplies/rounds, and no shadowing of the min() builtin.
+    total = round(abs(value) * 3600 * 100000)
+    deg, remainder = divmod(total, 3600 * 100000)
+    minutes, sec_scaled = divmod(remainder, 60 * 100000)
+    return ((deg, 1), (minutes, 1), (sec_scaled, 100000)), ref
 
 def set_gps_location(exif_dict, lat, lon):
     """Creates and sets the GPS EXIF data for JPG files."""
-    lat_deg = to_deg(lat, ["N", "S"])
-    lon_deg = to_deg(lon, ["E", "W"])
+    lat_dms, lat_ref = to_deg(lat, b'N', b'S')
+    lon_dms, lon_ref = to_deg(lon, b'E', b'W')
 
     exif_dict['GPS'] = {
         piexif.GPSIFD.GPSVersionID: (2, 0, 0, 0),
-        piexif.GPSIFD.GPSLatitudeRef: lat_deg[3],
-        piexif.GPSIFD.GPSLatitude: lat_deg[:3],
-        piexif.GPSIFD.GPSLongitudeRef: lon_deg[3],
-        piexif.GPSIFD.GPSLongitude: lon_deg[:3],
+        piexif.GPSIFD.GPSLatitudeRef: lat_ref,
+        piexif.GPSIFD.GPSLatitude: lat_dms,
+        piexif.GPSIFD.GPSLongitudeRef: lon_ref,
+        piexif.GPSIFD.GPSLongitude: lon_dms,
     }
     return exif_dict
 
-def find_json_for_media(media_filepath, all_json_files):
+def build_json_index(all_json_files):
+    """
+    Groups the JSON files by directory into
+    {dir: ({lowercase_basename: path}, sorted_basenames)}. Built once per run
+    so that find_json_for_media is a dict lookup instead of an O(N) rescan of
+    every JSON file for every media file; the sorted basename list feeds the
+    bisect prefix search without being re-sorted for every file in the same
+    directory.
+    """
+    grouped = collections.defaultdict(dict)
+    for json_path in all_json_files:
+        grouped[os.path.dirname(json_path)][os.path.basename(json_path).lower()] = json_path
+    return {dir_path: (json_map, sorted(json_map))
+            for dir_path, json_map in grouped.items()}
+
+class ExifToolBatch:
+    """
+    Wraps a single persistent 'exiftool -stay_open' process. Spawning
+    exiftool once and feeding it commands over stdin is an order of
+    magnitude faster than per-file tag writes through piexif, because
+    exiftool only pays its startup cost once for the whole batch.
+    """
+    def __init__(self):
+        self._process = subprocess.Popen(
+            ['exiftool', '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    def execute(self, *args):
+        """Sends one command to exiftool and waits for its {ready} sentinel."""
+        with self._lock:
+            self._sequence += 1
+            sentinel = f"{{ready{self._sequence}}}".encode('utf-8')
+            command = '\n'.join(args) + f"\n-execute{self._sequence}\n"
+            self._process.stdin.write(command.encode('utf-8'))
+            self._process.stdin.flush()
+            output = b''
+            while sentinel not in output:
+                chunk = self._process.stdout.read1(4096)
+                if not chunk:
+                    raise RuntimeError("exiftool process ended unexpectedly")
+                output += chunk
+            return output
+
+    def set_date_and_gps(self, filepath, date_str, lat=None, lon=None):
+        """Writes the EXIF date (and optionally GPS) tags to a single file."""
+        args = ['-overwrite_original',
+                f'-DateTimeOriginal={date_str}',
+                f'-CreateDate={date_str}',
+                f'-ModifyDate={date_str}']
+        if lat is not None and lon is not None:
+            args += [f'-GPSLatitude={abs(lat)}',
+                     f'-GPSLatitudeRef={"N" if lat >= 0 else "S"}',
+                     f'-GPSLongitude={abs(lon)}',
+                     f'-GPSLongitudeRef={"E" if lon >= 0 else "W"}']
+        args.append(filepath)
+        return self.execute(*args)
+
+    def close(self):
+        try:
+            self._process.stdin.write(b"-stay_open\nFalse\n")
+            self._process.stdin.flush()
+            self._process.wait(timeout=10)
+        except Exception:
+            self._process.kill()
+
+def start_exiftool_batch():
+    """Returns an ExifToolBatch if exiftool is on PATH, otherwise None."""
+    if shutil.which('exiftool') is None:
+        return None
+    try:
+        return ExifToolBatch()
+    except OSError:
+        return None
+
+@functools.lru_cache(maxsize=4096)
+def _generate_candidates(base_name_lower, ext_lower):
+    """
+    Builds the candidate JSON base names for a media name, in priority order.
+    Pure function of (base, ext), so edit/numbered variants and recurring
+    burst names across folders reuse the regex work via the LRU cache.
+    Returns (target_bases, core_name_lower, number_part, is_edited).
+    """
+    core_name_lower = base_name_lower
+    is_edited = False
+
+    if core_name_lower.endswith(('-edited', '_edited')) and len(core_name_lower) > 7:
+        core_name_lower = core_name_lower[:-7].strip()
+        is_edited = True
+
+    core_name_lower, number_part = _split_numbered_suffix(core_name_lower)
+    if number_part and not core_name_lower:
+        # A bare '(1)' style name isn't a duplicate marker; keep it intact
+        # (the old regex required at least one leading character too).
+        core_name_lower, number_part = number_part, ''
+    elif number_part:
+        core_name_lower = core_name_lower.strip()
+
+    # For videos, the JSON might use .jpg instead of the video extension.
+    base_ext_combinations = [ext_lower]
+    if ext_lower in ['.mp4', '.mov', '.mkv', '.flv', '.mp']:
+        base_ext_combinations.append('.jpg')
+
+    # Possible base names for the JSON file, e.g. for "photo(1).mp4" this
+    # holds "photo(1).mp4" and "photo(1).jpg", plus the bare base name for
+    # simpler JSONs like "photo(1).json".
+    target_bases = tuple(f"{core_name_lower}{number_part}{combo_ext}"
+                         for combo_ext in base_ext_combinations)
+    target_bases += (f"{core_name_lower}{number_part}",)
+
+    # Pre-build the exact-match JSON names too (most files resolve on these),
+    # so the lookup loop is pure dict probes with no string assembly.
+    exact_candidates = tuple(candidate
+                             for base in target_bases
+                             for candidate in (f"{base}.supplemental-metadata.json",
+                                               f"{base}.json"))
+    return target_bases, exact_candidates, core_name_lower, number_part, is_edited
+
+# Lazily-built per-directory map of JSON 'title' field -> json path, shared
+# by the deep-search fallback so each JSON is read at most once per run
+# instead of once per unmatched media file.
+_TITLE_RE = re.compile(rb'"title"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_title_index_by_dir = {}
+_title_index_lock = threading.Lock()
+
+def _get_title_index(media_dir, json_map_local):
+    """Returns {title: json_path} for a directory, building it on first use."""
+    with _title_index_lock:
+        title_index = _title_index_by_dir.get(media_dir)
+        if title_index is not None:
+            return title_index
+        title_index = {}
+        for json_path in json_map_local.values():
+            try:
+                with open(json_path, 'rb') as f:
+                    raw = f.read()
+                title_match = _TITLE_RE.search(raw)
+                if title_match:
+                    # Run the captured value through the JSON decoder so
+                    # escape sequences come out the same as a full parse.
+                    title = json.loads(b'"' + title_match.group(1) + b'"')
+                else:
+                    title = (orjson.loads(raw) if orjson is not None else json.loads(raw)).get('title')
+            except (ValueError, OSError):
+                continue
+            if title is not None and title not in title_index:
+                title_index[title] = json_path
+        _title_index_by_dir[media_dir] = title_index
+        return title_index
+
+def find_json_for_media(media_filepath, json_index):
     """
     Finds the corresponding JSON file for a given media file. This version
     is robust against various Google Takeout naming conventions, including:
@@ -83,104 +670,409 @@ def find_json_for_media(media_filepath, all_json_files):
     ext_lower = ext.lower()
 
     media_dir = os.path.dirname(media_filepath)
-    json_map_local = {os.path.basename(f).lower(): f for f in all_json_files if os.path.dirname(f) == media_dir}
-
-    # --- 1. Deconstruct the filename to find its core parts ---
-    core_name_lower = base_name_lower
-    number_part = ""
-    
-    edited_match = re.search(r'(.+?)([-_]edited)$', core_name_lower)
-    if edited_match:
-        core_name_lower = edited_match.group(1).strip()
-        logging.info(f"  - '{media_filename}' is an edited file. Targeting original's JSON...")
-
-    numbered_match = re.search(r'(.+?)(\(\d+\))$', core_name_lower)
-    if numbered_match:
-        core_name_lower = numbered_match.group(1).strip()
-        number_part = numbered_match.group(2)
-
-    # --- 2. Build target base names to search for ---
-    
-    # For videos, the JSON might use .jpg instead of the video extension.
-    base_ext_combinations = [ext_lower]
-    if ext_lower in ['.mp4', '.mov', '.mkv', '.flv', '.mp']:
-        base_ext_combinations.append('.jpg')
+    dir_entry = json_index.get(media_dir)
+    if not dir_entry:
+        # No JSONs in this directory at all - skip candidate generation,
+        # the prefix scan and the deep search outright.
+        return None
+    json_map_local, sorted_json_names = dir_entry
 
-    # Create a list of possible base names for the JSON file.
-    # e.g., for "photo(1).mp4", this would include "photo(1).mp4" and "photo(1).jpg"
-    target_bases = [f"{core_name_lower}{number_part}{combo_ext}" for combo_ext in base_ext_combinations]
-    
-    # Also add the base name without any extension for simpler JSONs like "photo(1).json"
-    target_bases.append(f"{core_name_lower}{number_part}")
+    # --- 1/2. Deconstruct the filename and build the target base names ---
+    target_bases, exact_candidates, core_name_lower, number_part, is_edited = _generate_candidates(base_name_lower, ext_lower)
+    if is_edited:
+        logger.info("  - '%s' is an edited file. Targeting original's JSON...", media_filename)
 
     # --- 3. Find Match: Exact, then Prefix ---
 
-    # A. Check for exact, full matches first (most reliable)
-    for base in target_bases:
-        # e.g., photo(1).jpg.supplemental-metadata.json
-        full_candidate = f"{base}.supplemental-metadata.json"
-        if full_candidate in json_map_local:
-            return json_map_local[full_candidate]
-        # e.g., photo(1).jpg.json
-        simple_candidate = f"{base}.json"
-        if simple_candidate in json_map_local:
-            return json_map_local[simple_candidate]
+    # A. Check for exact, full matches first (most reliable), e.g.
+    # photo(1).jpg.supplemental-metadata.json before photo(1).jpg.json
+    for candidate in exact_candidates:
+        json_path = json_map_local.get(candidate)
+        if json_path is not None:
+            return json_path
 
     # B. If no exact match, check for prefix matches (handles truncated suffixes)
-    # We sort the json_map by key length, descending. This makes "foo.jpg.supplemental.json"
-    # match before "foo.jpg.json" or "foo.jpg.supple.json", which is more specific and correct.
-    sorted_json_names = sorted(json_map_local.keys(), key=len, reverse=True)
-
+    # All names sharing a prefix are contiguous in a lexicographically sorted
+    # list, so bisect jumps straight to the candidate range instead of scanning
+    # every JSON in the directory. Among the matches we keep the longest name
+    # (e.g. "foo.jpg.supplemental.json" over "foo.jpg.json"), which is more
+    # specific and correct.
     for base in target_bases:
-        for json_name in sorted_json_names:
-            if json_name.startswith(base + '.'): # Ensure it's a full prefix match
-                return json_map_local[json_name]
+        prefix = base + '.'  # Ensure it's a full prefix match
+        best_match = None
+        for i in range(bisect.bisect_left(sorted_json_names, prefix), len(sorted_json_names)):
+            json_name = sorted_json_names[i]
+            if not json_name.startswith(prefix):
+                break
+            if best_match is None or len(json_name) > len(best_match):
+                best_match = json_name
+        if best_match is not None:
+            return json_map_local[best_match]
 
     # --- 4. Fallback: Deep search by title in JSON content ---
     target_filename_for_search = f"{core_name_lower}{number_part}{ext}"
     
-    logging.info(f"  - No filename match for '{media_filename}'. Starting deep search for title '{target_filename_for_search}'...")
-    for json_path in json_map_local.values():
-        try:
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            if data.get('title') == target_filename_for_search:
-                logging.info(f"  - Deep search SUCCESS: Found match in '{os.path.basename(json_path)}' by title.")
-                return json_path
-        except (json.JSONDecodeError, IOError):
-            continue
+    logger.info("  - No filename match for '%s'. Starting deep search for title '%s'...", media_filename, target_filename_for_search)
+    title_index = _get_title_index(media_dir, json_map_local)
+    json_path = title_index.get(target_filename_for_search)
+    if json_path is not None:
+        logger.info("  - Deep search SUCCESS: Found match in '%s' by title.", os.path.basename(json_path))
+        return json_path
 
     return None
 
+def scan_media_tree(root_directory, completed_directory, supported_extensions):
+    """
+    Walks the tree with os.scandir and classifies entries into media and
+    JSON lists. Unlike os.walk, this keeps the DirEntry objects scandir
+    already produced, so directory/file checks use their cached stat data
+    and no per-file os.path.join is needed (DirEntry.path is precomputed).
+    The Completed folder is skipped by never descending into it.
+    """
+    # Both paths hang off root_directory, so a normalized string compare is
+    # enough to recognize the Completed folder - no per-directory abspath
+    # (which hits getcwd) needed.
+    completed_norm = os.path.normpath(completed_directory)
+    all_media_files, all_json_files = [], []
+    # One dict probe routes each extension straight to its target list,
+    # replacing the set-membership test plus '.json' comparison per file.
+    target_list = dict.fromkeys(supported_extensions, all_media_files)
+    target_list['.json'] = all_json_files
+    stack = [root_directory]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            entries = os.scandir(current_dir)
+        except OSError as e:
+            logger.warning("  - Could not scan '%s': %s", current_dir, e)
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.normpath(entry.path) != completed_norm:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    name = entry.name
+                    dot = name.rfind('.')
+                    if dot < 0:
+                        continue
+                    bucket = target_list.get(name[dot:].lower())
+                    if bucket is not None:
+                        bucket.append(entry.path)
+    return all_media_files, all_json_files
+
 def delete_empty_folders(root_dir):
-    """Walks through a directory and removes any empty subfolders."""
+    """Removes any empty subfolders, deepest first."""
     deleted_folders_count = 0
-    # Walk the directory tree from the bottom up
-    for dirpath, dirnames, filenames in os.walk(root_dir, topdown=False):
-        # Don't try to delete the root directory itself or the completed directory
-        if os.path.abspath(dirpath) == os.path.abspath(root_dir) or "Completed" in dirpath:
-            continue
-            
-        if not dirnames and not filenames:
+    root_abs = os.path.abspath(root_dir)
+    # Explicit post-order DFS over scandir: each directory is pushed twice,
+    # first to list its subdirectories and again (after they were handled)
+    # to attempt the rmdir. Avoids materializing the whole tree the way
+    # os.walk(topdown=False) does, and a chain of nested empty folders
+    # disappears in a single pass because parents are tried after children.
+    stack = [(root_abs, False)]
+    while stack:
+        dirpath, children_done = stack.pop()
+        if not children_done:
             try:
-                os.rmdir(dirpath)
-                logging.info(f"  - Deleted empty folder: '{dirpath}'")
-                deleted_folders_count += 1
-            except OSError as e:
-                logging.error(f"  - Error deleting folder '{dirpath}': {e}")
+                with os.scandir(dirpath) as entries:
+                    subdirs = [e.path for e in entries if e.is_dir(follow_symlinks=False)]
+            except OSError:
+                continue
+            stack.append((dirpath, True))
+            # Don't descend into (or delete) the completed directory
+            stack.extend((sub, False) for sub in subdirs if "Completed" not in sub)
+            continue
+        # Don't try to delete the root directory itself
+        if dirpath == root_abs:
+            continue
+        try:
+            os.rmdir(dirpath)
+            logger.info("  - Deleted empty folder: '%s'", dirpath)
+            deleted_folders_count += 1
+        except OSError as e:
+            # Still-populated folders are expected here, not an error.
+            if e.errno not in (errno.ENOTEMPTY, errno.ENOENT):
+                logger.error("  - Error deleting folder '%s': %s", dirpath, e)
     if deleted_folders_count > 0:
         logging.info(f"\nSuccessfully deleted {deleted_folders_count} empty folders.")
     else:
         logging.info("\nNo empty folders found to delete.")
 
 
+def _write_image_metadata(media_filepath, filename, file_ext, timestamp, lat, lon, exiftool_batch):
+    """Writes the EXIF date (and GPS, when present) into a JPG/PNG/WEBP/HEIC."""
+    # Format the fixed EXIF layout directly from the time
+    # tuple; no datetime object or locale-aware strftime.
+    tm = time.localtime(timestamp)
+    date_str = (f"{tm.tm_year:04d}:{tm.tm_mon:02d}:{tm.tm_mday:02d} "
+                f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}")
+
+    if (file_ext in ['jpg', 'jpeg'] and lat is None
+            and jpeg_dates_match(media_filepath, date_str)):
+        # Re-run case: the file already carries exactly this date and no
+        # GPS needs adding, so skip the write entirely (the filesystem
+        # touch and move still happen in the caller).
+        logger.info("  - EXIF date already %s; no metadata write needed.", date_str)
+        return
+
+    if exiftool_batch is not None:
+        # Fast path: one persistent exiftool process handles all
+        # EXIF writes, avoiding a per-file load/dump/insert cycle.
+        exiftool_batch.set_date_and_gps(media_filepath, date_str, lat, lon)
+        logger.info("  - Found and set EXIF date to: %s (via exiftool)", date_str)
+        if lat is not None:
+            logger.info("  - Found and set GPS to: Lat %s, Lon %s", lat, lon)
+        return
+
+    if (file_ext in ['jpg', 'jpeg'] and lat is None
+            and _try_patch_jpeg_dates(media_filepath, date_str)):
+        # In-place fast path: the JPEG already carried all
+        # three date tags and there is no GPS to add, so the
+        # fixed-size values were overwritten directly instead
+        # of round-tripping every tag through piexif.
+        logger.info("  - Found and set EXIF date to: %s (in-place)", date_str)
+        return
+
+    if file_ext == 'heic':
+        # Only the piexif fallback below needs the HEIF codec loaded.
+        _ensure_heif()
+
+    exif_dict = {}
+    try:
+        if file_ext == 'png':
+            # Chunk scan only; no image decode just to
+            # fetch the EXIF blob.
+            exif_dict = piexif.load(read_png_exif(media_filepath))
+        elif file_ext == 'webp':
+            exif_dict = piexif.load(read_webp_exif(media_filepath))
+        elif file_ext == 'heic':
+            # open_heif exposes the metadata boxes without involving a
+            # decoder; Image.open would pull the whole plugin machinery
+            # in just to reach info['exif'].
+            exif_dict = piexif.load(pillow_heif.open_heif(media_filepath).info.get('exif') or b'')
+        else:
+            # Peek at the head first: no APP1 marker means there is
+            # nothing for piexif to parse (screenshots and app exports
+            # commonly ship without EXIF), so skip the load entirely.
+            with open(media_filepath, 'rb') as f:
+                head = f.read(65536)
+            if b'\xff\xe1' in head:
+                exif_dict = piexif.load(media_filepath)
+            else:
+                exif_dict = fresh_exif_dict()
+    except Exception:
+        exif_dict = fresh_exif_dict()
+
+    # Discard any loaded thumbnail right away so nothing
+    # below hangs on to it and piexif.dump never
+    # re-serializes those bytes.
+    exif_dict['thumbnail'] = None
+    exif_dict.pop('1st', None)
+
+    # One encode for all three tags; the format is pure ASCII by construction.
+    date_bytes = date_str.encode('ascii')
+    exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = date_bytes
+    exif_dict['Exif'][piexif.ExifIFD.DateTimeDigitized] = date_bytes
+    exif_dict['0th'][piexif.ImageIFD.DateTime] = date_bytes
+    logger.info("  - Found and set EXIF date to: %s", date_str)
+
+    if lat is not None:
+        exif_dict = set_gps_location(exif_dict, lat, lon)
+        logger.info("  - Found and set GPS to: Lat %s, Lon %s", lat, lon)
+
+    exif_bytes = piexif.dump(exif_dict)
+
+    if file_ext in ['jpg', 'jpeg']:
+        # Reuse the existing APP1 slot when the new EXIF fits; a full
+        # piexif.insert rewrites the whole file just to grow the header.
+        patched = False
+        try:
+            patched = patch_jpeg_app1(media_filepath, exif_bytes)
+        except Exception:
+            patched = False
+        if not patched:
+            piexif.insert(exif_bytes, media_filepath)
+    elif file_ext == 'heic':
+        # Saving through Pillow would round-trip the pixels
+        # through the HEVC encoder just to attach ~1KB of
+        # EXIF. open_heif keeps the original bitstream and
+        # quality=-1 re-saves it without a lossy re-encode.
+        try:
+            heif_file = pillow_heif.open_heif(media_filepath)
+            heif_file.info['exif'] = exif_bytes
+            heif_file.save(media_filepath, quality=-1)
+        except Exception:
+            with Image.open(media_filepath) as image:
+                image.save(media_filepath, exif=exif_bytes)
+    else:
+        # PNG/WEBP: splice the EXIF chunk into the existing
+        # container; decoding and re-encoding the pixels
+        # through Pillow is only the last resort.
+        patched = False
+        try:
+            if file_ext == 'png':
+                patched = write_png_exif(media_filepath, exif_bytes)
+            elif file_ext == 'webp':
+                patched = write_webp_exif(media_filepath, exif_bytes)
+        except Exception:
+            patched = False
+        if not patched:
+            with Image.open(media_filepath) as image:
+                image.save(media_filepath, exif=exif_bytes)
+
+def _write_video_metadata(media_filepath, filename, file_ext, timestamp, lat, lon, exiftool_batch):
+    """Stamps the internal creation date of a video or GIF container."""
+    tm = time.gmtime(timestamp)
+    date_str_iso = (f"{tm.tm_year:04d}-{tm.tm_mon:02d}-{tm.tm_mday:02d}"
+                    f"T{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}+00:00")
+    patched_atoms = False
+    if file_ext in ('mp4', 'mov'):
+        # In-place fast path: stamp the mvhd/tkhd creation
+        # times directly rather than having mutagen rewrite
+        # the whole moov box (O(filesize) on large videos).
+        try:
+            patched_atoms = patch_mp4_creation_time(media_filepath, timestamp)
+        except Exception:
+            patched_atoms = False
+    if patched_atoms:
+        logger.info("  - Found and set %s internal creation date to: %s (in-place)", file_ext.upper(), date_str_iso)
+    else:
+        # Go straight to the MP4 parser for the extensions we
+        # know it owns; mutagen.File would sniff the container.
+        video_cls = _VIDEO_CLASSES.get(file_ext)
+        video = video_cls(media_filepath) if video_cls else mutagen.File(media_filepath)
+        if video is not None:
+            if video.tags is None: video.add_tags()
+            tag_key = 'creation_time' if file_ext == 'flv' else 'DATE_RECORDED'
+            video.tags[tag_key] = date_str_iso
+            video.save()
+            logger.info("  - Found and set %s internal creation date to: %s", file_ext.upper(), date_str_iso)
+        else:
+            logger.warning("  - Could not write internal metadata for '%s' (unsupported by mutagen).", filename)
+
+def _write_raw_metadata(media_filepath, filename, file_ext, timestamp, lat, lon, exiftool_batch):
+    """RAW files only get the filesystem touch; EXIF is left alone for safety."""
+    logger.info("  - Found RAW file. Internal metadata will not be changed for safety.")
+
+# One dict probe replaces the old chain of extension-list membership tests
+# and keeps the format-to-writer mapping in a single data-driven place.
+_METADATA_WRITERS = {
+    **dict.fromkeys(('jpg', 'jpeg', 'heic', 'png', 'webp'), _write_image_metadata),
+    **dict.fromkeys(('mp4', 'mkv', 'gif', 'flv', 'mp', 'mov'), _write_video_metadata),
+    **dict.fromkeys(('nef', 'cr2', 'arw', 'dng'), _write_raw_metadata),
+}
+
+def process_one(media_filepath, json_index, root_directory, completed_directory, exiftool_batch=None):
+    """
+    Processes a single media file: finds its JSON, writes the metadata and
+    moves it to the Completed folder. Each file is fully independent, so this
+    is safe to run from multiple worker threads. Returns a (status, base_name)
+    tuple where status is 'processed' or 'skipped' and base_name is the
+    cleaned-up base name for the later JSON-deletion pass (or None).
+    """
+    filename = os.path.basename(media_filepath)
+    # Split and lowercase the name exactly once; every branch below
+    # dispatches on these instead of re-deriving them.
+    base_name, ext_with_dot = os.path.splitext(filename)
+    file_ext = ext_with_dot.lower().lstrip('.')
+
+    # --- Find the matching JSON file ---
+    json_filepath = find_json_for_media(media_filepath, json_index)
+
+    if not json_filepath:
+        logger.warning("\nSkipping '%s': No corresponding JSON file found.", filename)
+        return ('skipped', None)
+
+    logger.info("\nProcessing '%s' with JSON '%s'...", media_filepath, os.path.basename(json_filepath))
+    try:
+        timestamp, lat, lon = extract_metadata_fields(json_filepath)
+
+        if timestamp is not None:
+            # --- Update internal metadata (where possible and safe) ---
+            try:
+                writer = _METADATA_WRITERS.get(file_ext)
+                if writer is not None:
+                    writer(media_filepath, filename, file_ext, timestamp, lat, lon, exiftool_batch)
+            except Exception as e:
+                logger.warning("  - Failed to write internal metadata for '%s': %s", filename, e)
+
+            # --- Always update file system date and move file ---
+            relative_path = os.path.relpath(os.path.dirname(media_filepath), root_directory)
+            destination_dir = os.path.join(completed_directory, relative_path)
+            if destination_dir not in _created_dirs:
+                os.makedirs(destination_dir, exist_ok=True)
+                _created_dirs.add(destination_dir)
+
+            destination_filepath = os.path.join(destination_dir, filename)
+            try:
+                # Completed lives inside the root, so this is almost always a
+                # same-filesystem move: a single rename(2), no data copied.
+                os.replace(media_filepath, destination_filepath)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    # A permission or path problem won't get better by
+                    # copying; let the per-file handler below report it.
+                    raise
+                # Cross-device move - let shutil copy and unlink.
+                shutil.move(media_filepath, destination_filepath)
+            logger.info("  - Moved '%s' to '%s'", filename, destination_dir)
+
+            # Touch the file at its final location (after the move, so a
+            # cross-device copy can't clobber the times). Passing ns= skips
+            # the float-seconds path inside os.utime and maps directly onto
+            # utimensat on POSIX.
+            timestamp_ns = timestamp * 1_000_000_000
+            os.utime(destination_filepath, ns=(timestamp_ns, timestamp_ns))
+            logger.info("  - Set file 'Date modified' to match 'Date taken'.")
+
+            base_name_for_cleanup, _ = _split_numbered_suffix(base_name)
+            if base_name_for_cleanup.lower().endswith(('-edited', '_edited')):
+                base_name_for_cleanup = base_name_for_cleanup[:-7]
+            return ('processed', base_name_for_cleanup)
+        else:
+            logging.info("  - No 'photoTakenTime' found in JSON. Skipping metadata update.")
+            return ('skipped', None)
+    except Exception as e:
+        logger.error("  - An unexpected error occurred while processing '%s': %s", filename, e)
+        return ('skipped', None)
+
+
 def main():
     """Main function to process media files in the specified directory."""
     root_directory = '.'
     completed_directory = os.path.join(root_directory, "Completed")
     log_file = os.path.join(root_directory, "metadata_merge.log")
 
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', handlers=[logging.FileHandler(log_file, mode='w'), logging.StreamHandler()])
+    # Logging is fully decoupled from the worker threads: every record goes
+    # into a queue via a QueueHandler (cheap, no I/O under the logging lock)
+    # and a single QueueListener thread does the formatting and writing.
+    # The file handler is additionally buffered: records are flushed in
+    # 1024-line batches, immediately on any WARNING, and at exit. The
+    # console handler stays unbuffered since it doubles as the progress
+    # display.
+    log_format = '%(asctime)s - %(levelname)s - %(message)s'
+    file_target = logging.FileHandler(log_file, mode='w')
+    # The MemoryHandler hands buffered records to its target for formatting,
+    # so the format has to be set on the FileHandler itself.
+    file_target.setFormatter(logging.Formatter(log_format))
+    file_handler = logging.handlers.MemoryHandler(
+        capacity=1024, flushLevel=logging.WARNING, target=file_target)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(log_format))
+    log_queue = queue.Queue(-1)
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+    log_listener.start()
+    # Stopping the listener drains the queue into the handlers; registered
+    # after logging's own atexit hook so it runs before logging.shutdown()
+    # flushes and closes them.
+    atexit.register(log_listener.stop)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # QueueHandler pre-formats each record before enqueueing (merging the
+    # lazy %-args); keep that to the bare message so the listener's
+    # handlers apply the real format exactly once.
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
     logging.info(f"Log file created at: {os.path.abspath(log_file)}")
 
     if not os.path.exists(completed_directory):
@@ -192,125 +1084,44 @@ def main():
     skipped_files = 0
     processed_media_basenames = set() 
 
-    supported_extensions = ('.jpg', '.jpeg', '.mp4', '.mkv', '.heic', '.gif', '.flv', '.png', '.webp', '.mp', '.nef', '.cr2', '.arw', '.dng', '.mov')
+    supported_extensions = frozenset(('.jpg', '.jpeg', '.mp4', '.mkv', '.heic', '.gif', '.flv', '.png', '.webp', '.mp', '.nef', '.cr2', '.arw', '.dng', '.mov'))
     
-    all_media_files, all_json_files = [], []
-    for dirpath, _, filenames in os.walk(root_directory):
-        if os.path.abspath(dirpath).startswith(os.path.abspath(completed_directory)):
-            continue
-        for filename in filenames:
-            full_path = os.path.join(dirpath, filename)
-            _, ext = os.path.splitext(filename)
-            ext = ext.lower()
-            if ext in supported_extensions:
-                all_media_files.append(full_path)
-            elif ext == '.json':
-                all_json_files.append(full_path)
+    all_media_files, all_json_files = scan_media_tree(
+        root_directory, completed_directory, supported_extensions)
 
     if not all_media_files:
-        logging.info(f"No supported files found ({', '.join(supported_extensions)}).")
+        logging.info(f"No supported files found ({', '.join(sorted(supported_extensions))}).")
         return
     
     logging.info(f"Found {len(all_media_files)} supported files to process and {len(all_json_files)} JSON files.")
-    
-    for media_filepath in all_media_files:
-        filename = os.path.basename(media_filepath)
-        
-        # --- Find the matching JSON file ---
-        json_filepath = find_json_for_media(media_filepath, all_json_files)
-        
-        if json_filepath:
-            logging.info(f"\nProcessing '{media_filepath}' with JSON '{os.path.basename(json_filepath)}'...")
-            try:
-                with open(json_filepath, 'r', encoding='utf-8') as f:
-                    metadata = json.load(f)
-
-                if 'photoTakenTime' in metadata and 'timestamp' in metadata['photoTakenTime']:
-                    timestamp = int(metadata['photoTakenTime']['timestamp'])
-                    
-                    # --- Update internal metadata (where possible and safe) ---
-                    try:
-                        _, file_ext_with_dot = os.path.splitext(filename)
-                        file_ext = file_ext_with_dot.lower().replace('.', '')
-                        if file_ext in ['jpg', 'jpeg', 'heic', 'png', 'webp']:
-                            exif_dict = {}
-                            try:
-                                if file_ext in ['heic', 'png', 'webp']:
-                                    with Image.open(media_filepath) as image:
-                                        exif_dict = piexif.load(image.info.get('exif', b''))
-                                else:
-                                    exif_dict = piexif.load(media_filepath)
-                            except Exception:
-                                exif_dict = {"0th": {}, "Exif": {}, "GPS": {}, "1st": {}, "thumbnail": None}
-                            
-                            dt_object = datetime.fromtimestamp(timestamp)
-                            date_str = dt_object.strftime("%Y:%m:%d %H:%M:%S")
-                            exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal] = date_str.encode('utf-8')
-                            exif_dict['Exif'][piexif.ExifIFD.DateTimeDigitized] = date_str.encode('utf-8')
-                            exif_dict['0th'][piexif.ImageIFD.DateTime] = date_str.encode('utf-8')
-                            logging.info(f"  - Found and set EXIF date to: {date_str}")
-                            
-                            if 'geoData' in metadata and metadata['geoData'].get('latitude'):
-                                lat, lon = metadata['geoData']['latitude'], metadata['geoData']['longitude']
-                                exif_dict = set_gps_location(exif_dict, lat, lon)
-                                logging.info(f"  - Found and set GPS to: Lat {lat}, Lon {lon}")
-                            
-                            exif_dict['thumbnail'] = None
-                            exif_bytes = piexif.dump(exif_dict)
-                            
-                            if file_ext in ['jpg', 'jpeg']:
-                                 piexif.insert(exif_bytes, media_filepath)
-                            else:
-                                with Image.open(media_filepath) as image:
-                                    image.save(media_filepath, exif=exif_bytes)
-
-                        elif file_ext in ['mp4', 'mkv', 'gif', 'flv', 'mp', 'mov']:
-                             video = mutagen.File(media_filepath)
-                             if video is not None:
-                                utc_dt = datetime.fromtimestamp(timestamp, tz=timezone.utc)
-                                date_str_iso = utc_dt.isoformat()
-                                if video.tags is None: video.add_tags()
-                                tag_key = 'creation_time' if file_ext == 'flv' else 'DATE_RECORDED'
-                                video.tags[tag_key] = date_str_iso
-                                video.save()
-                                logging.info(f"  - Found and set {file_ext.upper()} internal creation date to: {date_str_iso}")
-                             else:
-                                logging.warning(f"  - Could not write internal metadata for '{filename}' (unsupported by mutagen).")
-                        
-                        elif file_ext in ['nef', 'cr2', 'arw', 'dng']:
-                             logging.info(f"  - Found RAW file. Internal metadata will not be changed for safety.")
-
-                    except Exception as e:
-                        logging.warning(f"  - Failed to write internal metadata for '{filename}': {e}")
-
-                    # --- Always update file system date and move file ---
-                    os.utime(media_filepath, (timestamp, timestamp))
-                    logging.info(f"  - Set file 'Date modified' to match 'Date taken'.")
-                    
-                    relative_path = os.path.relpath(os.path.dirname(media_filepath), root_directory)
-                    destination_dir = os.path.join(completed_directory, relative_path)
-                    os.makedirs(destination_dir, exist_ok=True)
-                    
-                    destination_filepath = os.path.join(destination_dir, filename)
-                    shutil.move(media_filepath, destination_filepath)
-                    logging.info(f"  - Moved '{filename}' to '{destination_dir}'")
-                    
-                    base_name_for_cleanup, _ = os.path.splitext(filename)
-                    base_name_for_cleanup = re.sub(r'\(\d+\)$', '', base_name_for_cleanup)
-                    base_name_for_cleanup = re.sub(r'[-_]edited$', '', base_name_for_cleanup, flags=re.IGNORECASE)
-                    processed_media_basenames.add(base_name_for_cleanup)
-                    
+
+    json_index = build_json_index(all_json_files)
+
+
+    # Each file is independent (own JSON, own EXIF write, own move), so fan the
+    # work out over a thread pool. The heavy lifting (piexif/mutagen/PIL and
+    # the file moves) is I/O-bound, and logging itself is thread-safe.
+    exiftool_batch = start_exiftool_batch()
+    if exiftool_batch is not None:
+        logging.info("Found exiftool on PATH; using a persistent batch process for EXIF writes.")
+
+    max_workers = (os.cpu_count() or 4) * 2
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                lambda p: process_one(p, json_index, root_directory, completed_directory, exiftool_batch),
+                all_media_files)
+            for status, base_name_for_cleanup in results:
+                if status == 'processed':
                     processed_files += 1
+                    processed_media_basenames.add(base_name_for_cleanup)
                 else:
-                    logging.info("  - No 'photoTakenTime' found in JSON. Skipping metadata update.")
                     skipped_files += 1
-            except Exception as e:
-                logging.error(f"  - An unexpected error occurred while processing '{filename}': {e}")
-                skipped_files += 1
-        else:
-            logging.warning(f"\nSkipping '{filename}': No corresponding JSON file found.")
-            skipped_files += 1
-    
+    finally:
+        if exiftool_batch is not None:
+            exiftool_batch.close()
+
+
     logging.info("\n" + "-"*20 + "\n      COMPLETE      \n" + "-"*20)
     logging.info(f"Processed: {processed_files} files")
     logging.info(f"Skipped:   {skipped_files} files")
@@ -319,19 +1130,34 @@ def main():
         logging.info("\n")
         delete_choice = input(f"Do you want to delete all JSON files corresponding to the {len(processed_media_basenames)} successfully processed media items? (yes/no): ").lower().strip()
         if delete_choice in ['yes', 'y']:
-            deleted_count = 0
             logging.info("\nDeleting related JSON files...")
+            # Instead of testing every processed base name against every JSON
+            # (O(jsons x basenames)), look up each JSON name's prefixes in the
+            # basename set: at most max_base_len O(1) membership checks per
+            # JSON, with identical match semantics.
+            max_base_len = max(len(b) for b in processed_media_basenames)
+            json_files_to_delete = []
             for json_path in all_json_files:
                 json_filename = os.path.basename(json_path)
-                for base_name in processed_media_basenames:
-                    if json_filename.startswith(base_name):
-                        try:
-                            os.remove(json_path)
-                            logging.info(f"  - Deleted '{os.path.basename(json_path)}' from '{os.path.dirname(json_path)}'")
-                            deleted_count += 1
-                            break 
-                        except OSError as e:
-                            logging.error(f"  - Error deleting '{json_path}': {e}")
+                limit = min(len(json_filename), max_base_len)
+                for prefix_len in range(0, limit + 1):
+                    if json_filename[:prefix_len] in processed_media_basenames:
+                        json_files_to_delete.append(json_path)
+                        break
+
+            def delete_json(json_path):
+                try:
+                    os.remove(json_path)
+                    logger.info("  - Deleted '%s' from '%s'", os.path.basename(json_path), os.path.dirname(json_path))
+                    return True
+                except OSError as e:
+                    logger.error("  - Error deleting '%s': %s", json_path, e)
+                    return False
+
+            # Unlinks are independent and purely I/O-bound, so issue them
+            # from the thread pool to keep several in flight at once.
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                deleted_count = sum(executor.map(delete_json, json_files_to_delete))
             logging.info(f"\nSuccessfully deleted {deleted_count} JSON files.")
         else:
             logging.info("\nSkipping JSON file deletion.")